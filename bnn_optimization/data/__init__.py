@@ -0,0 +1,22 @@
+def train_data(dataset, batch_size):
+    """Returns the training data of a zookeeper dataset.
+
+    Preprocess functions can provide their own input pipeline through a
+    `build_dataset(dataset, batch_size, training)` attribute, otherwise the
+    default zookeeper pipeline is used.
+    """
+    build_dataset = getattr(dataset.preprocess_fn, "build_dataset", None)
+    if build_dataset is None:
+        return dataset.train_data(batch_size)
+    return build_dataset(dataset, batch_size, training=True)
+
+
+def validation_data(dataset, batch_size):
+    """Returns the validation data of a zookeeper dataset.
+
+    See `train_data` for how to provide a custom input pipeline.
+    """
+    build_dataset = getattr(dataset.preprocess_fn, "build_dataset", None)
+    if build_dataset is None:
+        return dataset.validation_data(batch_size)
+    return build_dataset(dataset, batch_size, training=False)
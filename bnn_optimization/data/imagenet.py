@@ -14,8 +14,12 @@ More information can be obtained from the VGG website:
 www.robots.ox.ac.uk/~vgg/research/very_deep/
 """
 
+import functools
+import os
 import tensorflow as tf
+import tensorflow_datasets as tfds
 from zookeeper import registry
+from bnn_optimization import utils
 
 _R_MEAN = 123.68
 _G_MEAN = 116.78
@@ -25,15 +29,14 @@ _R_STD = 0.229 * 255
 _G_STD = 0.224 * 255
 _B_STD = 0.225 * 255
 
+# `(image - mean) / std` folded into a single `image * inv_std + bias`.
+_INV_STD = [1 / _R_STD, 1 / _G_STD, 1 / _B_STD]
+_BIAS = [-_R_MEAN / _R_STD, -_G_MEAN / _G_STD, -_B_MEAN / _B_STD]
+
 _RESIZE_SIDE_MIN = 256
 _RESIZE_SIDE_MAX = 512
 
 
-@registry.register_preprocess("imagenet2012", (224, 224, 3))
-def default(image, training):
-    return preprocess_image(image, 224, 224, is_training=training)
-
-
 def _get_h_w(image):
     """Convenience for grabbing the height and width of an image.
     """
@@ -41,8 +44,8 @@ def _get_h_w(image):
     return shape[0], shape[1]
 
 
-def _random_crop_and_flip(image, crop_height, crop_width):
-    """Crops the given image to a random part of the image, and randomly flips.
+def _random_crop(image, crop_height, crop_width):
+    """Crops the given image to a random part of the image.
 
     Args:
       image: a 3-D image tensor
@@ -64,10 +67,7 @@ def _random_crop_and_flip(image, crop_height, crop_width):
     total_crop_width = width - crop_width
     crop_left = tf.random.uniform([], maxval=total_crop_width + 1, dtype=tf.int32)
 
-    cropped = tf.slice(image, [crop_top, crop_left, 0], [crop_height, crop_width, -1])
-
-    cropped = tf.image.random_flip_left_right(cropped)
-    return cropped
+    return tf.slice(image, [crop_top, crop_left, 0], [crop_height, crop_width, -1])
 
 
 def _central_crop(image, crop_height, crop_width):
@@ -83,55 +83,77 @@ def _central_crop(image, crop_height, crop_width):
     """
     height, width = _get_h_w(image)
 
-    total_crop_height = height - crop_height
-    crop_top = total_crop_height // 2
-    total_crop_width = width - crop_width
-    crop_left = total_crop_width // 2
-    return tf.slice(image, [crop_top, crop_left, 0], [crop_height, crop_width, -1])
-
+    crop_top = (height - crop_height) // 2
+    crop_left = (width - crop_width) // 2
+    return tf.image.crop_to_bounding_box(
+        image, crop_top, crop_left, crop_height, crop_width
+    )
 
-def _mean_image_subtraction(image, means):
-    """Subtracts the given means from each image channel.
 
-    For example:
-      means = [123.68, 116.779, 103.939]
-      image = _mean_image_subtraction(image, means)
+def _random_crop_batch(images, crop_height, crop_width):
+    """Crops each image of a batch to a random part of the image.
 
-    Note that the rank of `image` must be known.
+    The crops are taken with two batched gathers, one over the rows and one over
+    the columns, instead of slicing image by image.
 
     Args:
-      image: a tensor of size [height, width, C].
-      means: a C-vector of values to subtract from each channel.
+      images: a 4-D tensor of equally sized images [batch, height, width, C].
+      crop_height: the new height.
+      crop_width: the new width.
 
     Returns:
-      the centered image.
+      4-D tensor with the cropped images.
+    """
+    shape = tf.shape(images)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+
+    crop_top = tf.random.uniform(
+        [batch_size, 1], maxval=height - crop_height + 1, dtype=tf.int32
+    )
+    crop_left = tf.random.uniform(
+        [batch_size, 1], maxval=width - crop_width + 1, dtype=tf.int32
+    )
+
+    rows = crop_top + tf.range(crop_height)
+    columns = crop_left + tf.range(crop_width)
+    images = tf.gather(images, rows, axis=1, batch_dims=1)
+    return tf.gather(images, columns, axis=2, batch_dims=1)
+
+
+def _random_flip_batch(images):
+    """Randomly flips each image of a batch horizontally.
 
-    Raises:
-      ValueError: If the rank of `image` is unknown, if `image` has a rank other
-        than three or if the number of channels in `image` doesn't match the
-        number of values in `means`.
+    Draws a single random mask for the whole batch and selects between the
+    original and the reversed images, instead of flipping image by image.
+
+    Args:
+      images: a 4-D tensor of size [batch, height, width, C].
+
+    Returns:
+      the randomly flipped images.
     """
-    if image.get_shape().ndims != 3:
-        raise ValueError("Input must be of size [height, width, C>0]")
-    num_channels = image.get_shape().as_list()[-1]
-    if len(means) != num_channels:
-        raise ValueError("len(means) must match the number of channels")
+    batch_size = tf.shape(images)[0]
+    flip = tf.random.uniform([batch_size, 1, 1, 1]) < 0.5
+    flip = tf.broadcast_to(flip, tf.shape(images))
+    return tf.where(flip, tf.reverse(images, axis=[2]), images)
 
-    # We have a 1-D tensor of means; convert to 3-D.
-    # We explicitly call `broadcast` instead of simply expanding dimensions
-    # for better performance: https://github.com/tensorflow/models/pull/6551
-    means = tf.broadcast_to(means, tf.shape(image))
 
-    return image - means
+def _normalize(images):
+    """Casts uint8 images to float32 and normalizes them per channel.
 
+    This runs as part of the model rather than the input pipeline, so that it is
+    executed on the accelerator. The cast and the normalization are written as
+    a single elementwise expression over constants, so that they can be fused
+    into one pass over the images.
 
-def _scale_normalization(image, stds):
-    # We have a 1-D tensor of means; convert to 3-D.
-    # We explicitly call `broadcast` instead of simply expanding dimensions
-    # for better performance: https://github.com/tensorflow/models/pull/6551
-    stds = tf.broadcast_to(stds, tf.shape(image))
+    Args:
+      images: a uint8 tensor of size [..., C].
 
-    return image / stds
+    Returns:
+      the normalized float32 images.
+    """
+    # The constants broadcast against the trailing channel dimension.
+    return tf.cast(images, tf.float32) * _INV_STD + _BIAS
 
 
 def _smallest_size_at_least(height, width, smallest_side):
@@ -150,41 +172,135 @@ def _smallest_size_at_least(height, width, smallest_side):
       new_height: an int32 scalar tensor indicating the new height.
       new_width: and int32 scalar tensor indicating the new width.
     """
-    smallest_side = tf.cast(smallest_side, tf.float32)
+    # Use integer arithmetic, with int64 intermediates to avoid overflows.
+    smallest_side = tf.cast(smallest_side, tf.int64)
+    smaller_dim = tf.cast(tf.minimum(height, width), tf.int64)
 
-    height, width = tf.cast(height, tf.float32), tf.cast(width, tf.float32)
+    new_height = tf.cast(
+        tf.cast(height, tf.int64) * smallest_side // smaller_dim, tf.int32
+    )
+    new_width = tf.cast(
+        tf.cast(width, tf.int64) * smallest_side // smaller_dim, tf.int32
+    )
 
-    smaller_dim = tf.minimum(height, width)
-    scale_ratio = smallest_side / smaller_dim
+    return new_height, new_width
 
-    new_height = tf.cast(height * scale_ratio, tf.int32)
-    new_width = tf.cast(width * scale_ratio, tf.int32)
 
-    return new_height, new_width
+def _resize(image, height, width):
+    """Resizes a uint8 image to the given size.
+
+    Downscaling uses area interpolation, which averages all source pixels that
+    make up an output pixel. Upscaling uses bilinear interpolation.
+
+    Args:
+      image: A 3-D uint8 image `Tensor`.
+      height: The height after resizing.
+      width: The width after resizing.
+
+    Returns:
+      resized_image: A 3-D uint8 tensor containing the resized image.
+    """
+
+    def resize(method):
+        return lambda: tf.image.resize(image, [height, width], method=method)
+
+    input_height, _ = _get_h_w(image)
+    resized_image = tf.cond(
+        height < input_height,
+        resize(tf.image.ResizeMethod.AREA),
+        resize(tf.image.ResizeMethod.BILINEAR),
+    )
+    # Resizing returns float32, convert back so that cropping, flipping and
+    # batching only have to move a quarter of the bytes.
+    return tf.saturate_cast(tf.round(resized_image), tf.uint8)
 
 
 def _aspect_preserving_resize(image, smallest_side):
     """Resize images preserving the original aspect ratio.
 
     Args:
-      image: A 3-D image `Tensor`.
+      image: A 3-D uint8 image `Tensor`.
       smallest_side: A python integer or scalar `Tensor` indicating the size of
         the smallest side after resize.
 
     Returns:
-      resized_image: A 3-D tensor containing the resized image.
+      resized_image: A 3-D uint8 tensor containing the resized image.
     """
 
     height, width = _get_h_w(image)
     new_height, new_width = _smallest_size_at_least(height, width, smallest_side)
+    return _resize(image, new_height, new_width)
 
-    resized_image = tf.compat.v1.image.resize(
-        image,
-        [new_height, new_width],
-        method=tf.image.ResizeMethod.BILINEAR,
-        align_corners=False,
-    )
-    return resized_image
+
+def _decode_and_random_crop(
+    image_bytes,
+    crop_height,
+    crop_width,
+    resize_side_min=_RESIZE_SIDE_MIN,
+    resize_side_max=_RESIZE_SIDE_MAX,
+):
+    """Decodes a random crop of an image as taken by `preprocess_image`.
+
+    Instead of decoding the whole image, resizing it and then cropping it, the
+    random crop window is mapped back onto the original image. Only this window
+    is decoded and then resized to the crop size.
+
+    A few ImageNet images are not JPEGs despite their file name. These are
+    decoded completely and passed through `preprocess_image` instead.
+
+    Args:
+      image_bytes: A scalar string `Tensor` holding an encoded image.
+      crop_height: The height of the image after preprocessing.
+      crop_width: The width of the image after preprocessing.
+      resize_side_min: The lower bound for the smallest side of the image for
+        aspect-preserving resizing.
+      resize_side_max: The upper bound for the smallest side of the image for
+        aspect-preserving resizing.
+
+    Returns:
+      A cropped uint8 image of size [crop_height, crop_width, 3].
+    """
+
+    def decode_and_crop_jpeg():
+        shape = tf.io.extract_jpeg_shape(image_bytes)
+        height, width = shape[0], shape[1]
+        resize_side = tf.random.uniform(
+            [], minval=resize_side_min, maxval=resize_side_max + 1, dtype=tf.int32
+        )
+
+        # The size of the crop in the original image, before resizing.
+        smaller_dim = tf.minimum(height, width)
+        window_height = tf.maximum(crop_height * smaller_dim // resize_side, 1)
+        window_width = tf.maximum(crop_width * smaller_dim // resize_side, 1)
+
+        crop_top = tf.random.uniform(
+            [], maxval=height - window_height + 1, dtype=tf.int32
+        )
+        crop_left = tf.random.uniform(
+            [], maxval=width - window_width + 1, dtype=tf.int32
+        )
+
+        window = tf.stack([crop_top, crop_left, window_height, window_width])
+        image = tf.io.decode_and_crop_jpeg(
+            image_bytes, window, channels=3, dct_method="INTEGER_FAST"
+        )
+        return _resize(image, crop_height, crop_width)
+
+    def decode_and_crop():
+        # `decode_jpeg` detects the image format, so it decodes PNGs as well.
+        image = tf.image.decode_jpeg(image_bytes, channels=3)
+        return preprocess_image(
+            image,
+            crop_height,
+            crop_width,
+            is_training=True,
+            resize_side_min=resize_side_min,
+            resize_side_max=resize_side_max,
+        )
+
+    image = tf.cond(tf.io.is_jpeg(image_bytes), decode_and_crop_jpeg, decode_and_crop)
+    image.set_shape([crop_height, crop_width, 3])
+    return image
 
 
 def preprocess_image(
@@ -195,10 +311,14 @@ def preprocess_image(
     resize_side_min=_RESIZE_SIDE_MIN,
     resize_side_max=_RESIZE_SIDE_MAX,
 ):
-    """Preprocesses the given image.
+    """Resizes and crops the given image.
+
+    This covers the preprocessing steps which depend on the size of each
+    individual image. The remaining steps are applied to whole batches by
+    `preprocess_image_batch`.
 
     Args:
-      image: A `Tensor` representing an image of arbitrary size.
+      image: A uint8 `Tensor` representing an image of arbitrary size.
       output_height: The height of the image after preprocessing.
       output_width: The width of the image after preprocessing.
       is_training: `True` if we're preprocessing the image for training and
@@ -212,14 +332,14 @@ def preprocess_image(
           [resize_size_min, resize_size_max].
 
     Returns:
-      A preprocessed image.
+      A cropped uint8 image of size [output_height, output_width, C].
     """
     if is_training:
         # For training, we want to randomize some of the distortions.
         resize_side = tf.random.uniform(
             [], minval=resize_side_min, maxval=resize_side_max + 1, dtype=tf.int32
         )
-        crop_fn = _random_crop_and_flip
+        crop_fn = _random_crop
     else:
         resize_side = resize_side_min
         crop_fn = _central_crop
@@ -229,7 +349,182 @@ def preprocess_image(
     image = crop_fn(image, output_height, output_width)
 
     image.set_shape([output_height, output_width, num_channels])
+    return image
+
+
+def preprocess_image_batch(images, training=False):
+    """Preprocesses a batch of images of equal size.
+
+    The normalization is left to the model, see `_normalize`, so that batches
+    are transferred to the accelerator as uint8.
+
+    Args:
+      images: A uint8 `Tensor` of size [batch, height, width, C] as returned by
+        `preprocess_image`.
+      training: `True` if we're preprocessing the images for training and
+        `False` otherwise.
+
+    Returns:
+      The preprocessed uint8 batch of images.
+    """
+    if training:
+        images = _random_flip_batch(images)
+    return images
+
+
+def _tfrecord_pattern(dataset, split):
+    """Returns the file pattern of the TFRecord files of a prepared tfds split."""
+    builder = tfds.builder(dataset.dataset_name, data_dir=dataset.data_dir)
+    return os.path.join(builder.data_dir, f"{builder.name}-{split}.tfrecord*")
+
+
+def _parse_example(serialized, num_classes):
+    """Parses a serialized tfds ImageNet example.
+
+    Args:
+      serialized: a scalar string tensor holding a `tf.train.Example`.
+      num_classes: the number of classes used for the one-hot labels.
 
-    image = tf.cast(image, tf.float32)
-    image = _mean_image_subtraction(image, [_R_MEAN, _G_MEAN, _B_MEAN])
-    return _scale_normalization(image, [_R_STD, _G_STD, _B_STD])
+    Returns:
+      The JPEG encoded image and its one-hot label.
+    """
+    features = tf.io.parse_single_example(
+        serialized,
+        {
+            "image": tf.io.FixedLenFeature([], tf.string),
+            "label": tf.io.FixedLenFeature([], tf.int64),
+        },
+    )
+    return features["image"], tf.one_hot(features["label"], num_classes)
+
+
+def build_imagenet_dataset(dataset, batch_size, training, center_crop=False):
+    """Builds the ImageNet input pipeline.
+
+    Instead of going through `tfds.load`, the TFRecord files prepared by tfds
+    are read in parallel and decoded directly. During training only the random
+    crop of each JPEG is decoded. Unlike the zookeeper pipeline, which runs the
+    whole preprocessing per image, only the resizing and cropping are done per
+    image. Flipping is applied after batching, so that it is dispatched once per
+    batch instead of once per image, and normalization is left to the model.
+    If the dataset has a `cache_dir`, the encoded records are cached.
+
+    With `center_crop`, the images are instead resized to a smallest side of
+    `_RESIZE_SIDE_MIN` and center cropped before the cache, so that decoding and
+    resizing only happen during the first epoch. During training the random
+    crops are then taken from whole batches of these square images, which
+    means that the resize side is no longer randomized and everything outside
+    the center crop is never seen.
+
+    Args:
+      dataset: The `zookeeper.data.Dataset` to load the data from.
+      batch_size: The number of images per batch.
+      training: `True` to build the training pipeline and `False` to build the
+        validation pipeline.
+      center_crop: `True` to decode, resize and center crop the images before
+        caching them.
+
+    Returns:
+      A `tf.data.Dataset` of `(images, labels)` batches.
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    split = dataset.train_split if training else dataset.validation_split
+
+    def center_crop_fn(serialized):
+        image_bytes, label = _parse_example(serialized, dataset.num_classes)
+        image = tf.image.decode_jpeg(image_bytes, channels=3)
+        image = _aspect_preserving_resize(image, _RESIZE_SIDE_MIN)
+        # Keep equally sized images, so that training crops can be taken from
+        # whole batches.
+        size = _RESIZE_SIDE_MIN if training else 224
+        image = _central_crop(image, size, size)
+        image.set_shape([size, size, 3])
+        return image, label
+
+    def crop_fn(serialized):
+        image_bytes, label = _parse_example(serialized, dataset.num_classes)
+        if training:
+            image = _decode_and_random_crop(image_bytes, 224, 224)
+        else:
+            image = tf.image.decode_jpeg(image_bytes, channels=3)
+            image = preprocess_image(image, 224, 224, is_training=False)
+        return image, label
+
+    def batch_fn(images, labels):
+        if center_crop and training:
+            images = _random_crop_batch(images, 224, 224)
+        images = preprocess_image_batch(images, training=training)
+        # The models expect NHWC batches of a known size.
+        images = tf.ensure_shape(images, [batch_size, 224, 224, 3])
+        return images, labels
+
+    files = tf.data.Dataset.list_files(
+        _tfrecord_pattern(dataset, split), shuffle=training
+    )
+    data = files.interleave(
+        tf.data.TFRecordDataset, cycle_length=autotune, num_parallel_calls=autotune
+    )
+    # Only deterministic steps may happen before the cache, everything random
+    # has to come after it. Don't reuse zookeeper's "train" and "eval" caches,
+    # which hold tfds examples.
+    if center_crop:
+        data = data.map(center_crop_fn, num_parallel_calls=autotune)
+        cache_name = "train_center256" if training else "eval_center224"
+    else:
+        cache_name = "train_records" if training else "eval_records"
+    data = dataset.maybe_cache(data, cache_name)
+    if training:
+        data = data.shuffle(10 * batch_size)
+
+    data = data.repeat()
+    if not center_crop:
+        data = data.map(crop_fn, num_parallel_calls=autotune)
+    data = (
+        data.batch(batch_size, drop_remainder=True)
+        .map(batch_fn, num_parallel_calls=autotune)
+        .prefetch(autotune)
+    )
+
+    options = tf.data.Options()
+    # The order of the examples doesn't matter, so don't let a slow example
+    # hold up the ones behind it.
+    options.experimental_deterministic = False
+    options.experimental_optimization.apply_default_optimizations = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    # Leave a couple of cores per GPU to the training loop, so that the input
+    # pipeline doesn't compete with it for threads.
+    options.experimental_threading.private_threadpool_size = max(
+        1, os.cpu_count() - 2 * utils.num_gpus()
+    )
+    options.experimental_threading.max_intra_op_parallelism = 1
+    return data.with_options(options)
+
+
+@registry.register_preprocess("imagenet2012", (224, 224, 3))
+def default(image, training):
+    image = preprocess_image(image, 224, 224, is_training=training)
+    return preprocess_image_batch(image[tf.newaxis], training=training)[0]
+
+
+default.build_dataset = build_imagenet_dataset
+default.input_dtype = tf.uint8
+default.device_preprocess = _normalize
+
+
+@registry.register_preprocess("imagenet2012", (224, 224, 3))
+def cached_center256(image, training):
+    if not training:
+        return default(image, training=False)
+    image = _aspect_preserving_resize(image, _RESIZE_SIDE_MIN)
+    image = _central_crop(image, _RESIZE_SIDE_MIN, _RESIZE_SIDE_MIN)
+    image = _random_crop(image, 224, 224)
+    image.set_shape([224, 224, 3])
+    return preprocess_image_batch(image[tf.newaxis], training=True)[0]
+
+
+cached_center256.build_dataset = functools.partial(
+    build_imagenet_dataset, center_crop=True
+)
+cached_center256.input_dtype = tf.uint8
+cached_center256.device_preprocess = _normalize
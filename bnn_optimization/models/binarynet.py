@@ -1,7 +1,7 @@
 from zookeeper import registry, HParams
 import larq as lq
 import tensorflow as tf
-from bnn_optimization import optimizers
+from bnn_optimization import optimizers, utils
 
 
 @registry.register_model
@@ -14,6 +14,7 @@ def binarynet(hparams, dataset):
     )
     return tf.keras.models.Sequential(
         [
+            *utils.model_input_layers(dataset),
             # don't quantize inputs in first layer
             lq.layers.QuantConv2D(
                 hparams.filters,
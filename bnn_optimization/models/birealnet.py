@@ -1,7 +1,7 @@
 from zookeeper import registry, HParams
 import larq as lq
 import tensorflow as tf
-from bnn_optimization import optimizers
+from bnn_optimization import optimizers, utils
 
 
 @registry.register_model
@@ -38,7 +38,7 @@ def birealnet(args, dataset):
         x = tf.keras.layers.BatchNormalization(momentum=0.8)(x)
         return tf.keras.layers.add([x, shortcut])
 
-    img_input = tf.keras.layers.Input(shape=dataset.input_shape)
+    img_input, x = utils.model_input(dataset)
 
     # layer 1
     out = tf.keras.layers.Conv2D(
@@ -48,7 +48,7 @@ def birealnet(args, dataset):
         kernel_initializer=args.kernel_initializer,
         padding="same",
         use_bias=False,
-    )(img_input)
+    )(x)
     out = tf.keras.layers.BatchNormalization(momentum=0.8)(out)
     out = tf.keras.layers.MaxPool2D(3, strides=2, padding="same")(out)
 
@@ -11,6 +11,10 @@ def train(build_model, dataset, hparams, output_dir, epochs, tensorboard):
     from bnn_optimization import utils, data
     import tensorflow as tf
 
+    # The input pipelines produce NHWC batches, keep the models in the same
+    # layout so no transposes are needed in front of the first convolution.
+    tf.keras.backend.set_image_data_format("channels_last")
+
     initial_epoch = utils.get_current_epoch(output_dir)
     model_path = path.join(output_dir, "model")
     callbacks = [utils.ModelCheckpoint(filepath=model_path, save_weights_only=True)]
@@ -32,8 +36,8 @@ def train(build_model, dataset, hparams, output_dir, epochs, tensorboard):
         )
 
     with tf.device("/cpu:0"):
-        train_data = dataset.train_data(hparams.batch_size)
-        validation_data = dataset.validation_data(hparams.batch_size)
+        train_data = data.train_data(dataset, hparams.batch_size)
+        validation_data = data.validation_data(dataset, hparams.batch_size)
 
     with utils.get_distribution_scope(hparams.batch_size):
         model = build_model(hparams, dataset)
@@ -2,26 +2,86 @@ import os
 import sys
 import tensorflow as tf
 import contextlib
+import functools
 import json
-from tensorflow.python.eager.context import num_gpus
+
+
+def num_gpus():
+    return len(tf.config.experimental.list_physical_devices("GPU"))
+
+
+@functools.lru_cache(maxsize=8)
+def _read_epoch(path, mtime):
+    # `mtime` is only part of the cache key, so that updates are picked up.
+    with tf.io.gfile.GFile(path, "r") as f:
+        return json.load(f).get("epoch", 0)
 
 
 def get_current_epoch(output_dir):
-    try:
-        with open(os.path.join(output_dir, "stats.json"), "r") as f:
-            return json.load(f)["epoch"]
-    except:
+    path = os.path.join(output_dir, "stats.json")
+    if not tf.io.gfile.exists(path):
         return 0
+    return _read_epoch(path, tf.io.gfile.stat(path).mtime_nsec)
 
 
 class ModelCheckpoint(tf.keras.callbacks.ModelCheckpoint):
     def on_epoch_end(self, epoch, logs=None):
         super().on_epoch_end(epoch, logs=logs)
-        with open(os.path.join(os.path.dirname(self.filepath), "stats.json"), "w") as f:
-            return json.dump({"epoch": epoch + 1}, f)
+        path = os.path.join(os.path.dirname(self.filepath), "stats.json")
+        # Write to a temporary file and move it into place, so that an
+        # interrupted write never leaves a partial `stats.json` behind.
+        with tf.io.gfile.GFile(f"{path}.tmp", "w") as f:
+            json.dump({"epoch": epoch + 1}, f)
+        tf.io.gfile.rename(f"{path}.tmp", path, overwrite=True)
+
+
+def model_input(dataset):
+    """Creates the input of a model trained on `dataset`.
+
+    Preprocess functions can move their final steps into the model, so that
+    these run on the accelerator, by setting an `input_dtype` and a
+    `device_preprocess` function which is applied to the model input.
+
+    Returns:
+      The input tensor and the tensor to pass to the first layer of the model.
+    """
+    preprocess_fn = dataset.preprocess_fn
+    inputs = tf.keras.layers.Input(
+        shape=dataset.input_shape,
+        dtype=getattr(preprocess_fn, "input_dtype", tf.keras.backend.floatx()),
+    )
+    device_preprocess = getattr(preprocess_fn, "device_preprocess", None)
+    if device_preprocess is None:
+        return inputs, inputs
+    return inputs, tf.keras.layers.Lambda(device_preprocess)(inputs)
+
+
+def model_input_layers(dataset):
+    """Returns the input layers of a `Sequential` model trained on `dataset`.
+
+    This is the `Sequential` counterpart of `model_input`. The returned list is
+    empty if the preprocess function doesn't move any steps into the model.
+    """
+    preprocess_fn = dataset.preprocess_fn
+    device_preprocess = getattr(preprocess_fn, "device_preprocess", None)
+    if device_preprocess is None:
+        return []
+    return [
+        tf.keras.layers.InputLayer(
+            input_shape=dataset.input_shape,
+            dtype=getattr(preprocess_fn, "input_dtype", tf.keras.backend.floatx()),
+        ),
+        tf.keras.layers.Lambda(device_preprocess),
+    ]
 
 
 def get_distribution_scope(batch_size):
+    """Returns the scope to build and compile the model in.
+
+    With multiple GPUs a `MirroredStrategy` is used. It runs the input pipeline
+    once and splits each global batch, so that every replica gets
+    `batch_size // num_replicas` examples.
+    """
     if num_gpus() > 1:
         strategy = tf.distribute.MirroredStrategy()
         assert (